@@ -0,0 +1,63 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+
+from coupons import app
+from fake_mongo import FakeCollection
+from mock_data import _NOW, mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon, mock_customer, mock_product
+
+# Freeze the app's clock once for the whole session so coupon validity windows
+# can be literal dates. The app reads the time only through utcnow().
+@pytest.fixture(scope="session", autouse=True)
+def frozen_time():
+    with patch('coupons.utcnow', return_value=_NOW):
+        yield _NOW
+
+# Patch the three collections once for the whole session; tests reset the
+# fakes between runs instead of re-patching. The startup database the lifespan
+# uses is patched to hand out the same fakes.
+@pytest.fixture(scope="session")
+def _patched_collections(request):
+    request.addfinalizer(patch.stopall)
+    collections = tuple(
+        patch(f'coupons.{name}_collection', new=FakeCollection(key)).start()
+        for name, key in (
+            ("customers", "_id"),
+            ("products", "product_id"),
+            ("coupons", "coupon_id")
+        )
+    )
+    patch('coupons.startup_db', new=dict(zip(("customers", "products", "coupons"), collections))).start()
+    return collections
+
+# Reset the session-wide fake collections and seed the mock data; requested
+# explicitly by the tests that talk to the database
+@pytest.fixture
+def mock_db_connections(_patched_collections):
+    mock_customers, mock_products, mock_coupons = _patched_collections
+    mock_customers.reset([mock_customer])
+    mock_products.reset([mock_product])
+    mock_coupons.reset([mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon])
+    
+    with patch.dict('coupons.applicable_coupons_cache', clear=True):
+        yield mock_customers, mock_products, mock_coupons
+
+# One client for the whole session, so the app's lifespan (index creation and
+# cart migration) runs once instead of per test, against the patched collections
+@pytest.fixture(scope="session")
+def client(_patched_collections):
+    with TestClient(app) as test_client:
+        yield test_client
+
+# Async tests run on asyncio only, the event loop the app runs on
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+# Client for tests that overlap several requests on one event loop instead of
+# sending them one at a time through the TestClient portal
+@pytest.fixture
+async def async_client(_patched_collections):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as test_client:
+        yield test_client
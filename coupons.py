@@ -1,19 +1,92 @@
-from fastapi import FastAPI, HTTPException
-from pymongo import MongoClient
-from typing import Dict, List, Optional, Union
+from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from typing import Annotated, Dict, List, Optional, Union
 from bson import ObjectId
-from pydantic import BaseModel, Field
-from datetime import datetime
+from bson.errors import InvalidId
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
+from pydantic import BaseModel, Discriminator, Field, Tag
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from discounts import compute_discount, discount_expression, index_cart, parse_terms
+import asyncio
 import json
+import orjson
+import time
 
-app = FastAPI(title="Coupon Management API")
+# Decode ObjectIds straight to strings while BSON is parsed, so coupon
+# documents can be returned as JSON without a separate conversion pass
+class ObjectIdAsString(TypeDecoder):
+    bson_type = ObjectId
+    
+    def transform_bson(self, value):
+        return str(value)
 
 # MongoDB Connection
-client = MongoClient("mongodb://localhost:27017/")
+# The pool is sized for many in-flight requests on the event loop, and wire
+# compression (zstd, falling back to zlib) shrinks the larger coupon payloads
+MONGO_URI = "mongodb://localhost:27017/"
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=200,
+    minPoolSize=20,
+    compressors="zstd,zlib",
+    zlibCompressionLevel=3,
+    socketTimeoutMS=2000,
+    serverSelectionTimeoutMS=2000,
+    retryWrites=True
+)
 db = client["ecommerce_db"]
 customers_collection = db["customers"]
 products_collection = db["products"]
-coupons_collection = db["coupons"]
+coupons_collection = db.get_collection(
+    "coupons",
+    codec_options=CodecOptions(type_registry=TypeRegistry([ObjectIdAsString()]))
+)
+
+# The startup index builds and cart migration scan whole collections, so they
+# go through a separate client without the 2 s socket timeout sized for requests
+startup_db = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)["ecommerce_db"]
+
+# In-process cache of applicable-coupon rankings keyed by (tier, cart contents,
+# coupon generation). Entries expire after APPLICABLE_COUPONS_TTL seconds; every
+# coupon write bumps the generation and drops the cache, so rankings computed
+# against the old coupon set are never stored or served.
+APPLICABLE_COUPONS_TTL = 60
+APPLICABLE_COUPONS_CACHE_SIZE = 4096
+applicable_coupons_cache: Dict = {}
+applicable_coupons_generation = 0
+
+# Upper bound on the customers in one batch applicable-coupons request, which
+# bounds both its $in query and the customers x coupons loop
+MAX_BATCH_CUSTOMERS = 100
+
+# Helper function to invalidate cached rankings after a coupon write
+def invalidate_applicable_coupons():
+    global applicable_coupons_generation
+    applicable_coupons_generation += 1
+    applicable_coupons_cache.clear()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Indexes backing coupon_id lookups, the active-coupon filter and product checks
+    await startup_db["coupons"].create_index([("coupon_id", 1)], unique=True)
+    await startup_db["coupons"].create_index([("is_active", 1), ("user_tiers", 1), ("valid_from", 1), ("valid_until", 1)])
+    await startup_db["products"].create_index([("product_id", 1)], unique=True)
+    
+    # Carts used to be stored as a map keyed by product_id; convert any that remain
+    await startup_db["customers"].update_many(
+        {"cart": {"$exists": True, "$not": {"$type": "array"}}},
+        [{"$set": {"cart": {"$map": {
+            "input": {"$objectToArray": "$cart"},
+            "in": {"product_id": "$$this.k", "quantity": "$$this.v.quantity", "price": "$$this.v.price"}
+        }}}}]
+    )
+    yield
+
+app = FastAPI(title="Coupon Management API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Pydantic Models for request validation
 class ProductItem(BaseModel):
@@ -21,6 +94,15 @@ class ProductItem(BaseModel):
     quantity: int
     price: float
 
+class CartQuantityUpdate(BaseModel):
+    product_id: str
+    quantity: int
+
+class CartChanges(BaseModel):
+    add: List[ProductItem] = []
+    update: List[CartQuantityUpdate] = []
+    remove: List[str] = []  # Product IDs to drop from the cart
+
 class CartBasedCoupon(BaseModel):
     threshold: float
     discount_percentage: float
@@ -33,22 +115,61 @@ class ProductBasedCoupon(BaseModel):
 
 class BxGyCoupon(BaseModel):
     buy_products: List[str]  # List of product IDs eligible for "Buy" part
-    buy_quantity: int  # Number of items to buy
+    buy_quantity: int = Field(gt=0)  # Number of items to buy
     get_products: List[str]  # List of product IDs eligible for "Get" part
-    get_quantity: int  # Number of items to get free/discounted
+    get_quantity: int = Field(gt=0)  # Number of items to get free/discounted
     discount_percentage: float = 100.0  # Default is 100% (free)
     repetition_limit: Optional[int] = 1  # How many times this offer can be applied
 
+# Helper function to infer a coupon's type from the fields present in its details
+def coupon_type(details: Union[Dict, BaseModel]) -> Optional[str]:
+    if isinstance(details, dict):
+        fields = details
+    elif isinstance(details, BaseModel):
+        fields = type(details).model_fields
+    else:
+        return None
+    if "product_ids" in fields:
+        return "product-wise"
+    elif "threshold" in fields:
+        return "cart-wise"
+    elif "buy_products" in fields:
+        return "bxgy"
+    return None
+
+# Details are validated against the single model their shape selects,
+# instead of trying each member of the union in turn
+CouponDetails = Annotated[
+    Union[
+        Annotated[CartBasedCoupon, Tag("cart-wise")],
+        Annotated[ProductBasedCoupon, Tag("product-wise")],
+        Annotated[BxGyCoupon, Tag("bxgy")]
+    ],
+    Discriminator(
+        coupon_type,
+        custom_error_type="invalid_coupon_details",
+        custom_error_message="details must describe a cart-wise, product-wise or bxgy coupon"
+    )
+]
+
 class CouponCreate(BaseModel):
     coupon_id: str
     type: str
-    details: Union[CartBasedCoupon, ProductBasedCoupon, BxGyCoupon, Dict]
+    details: CouponDetails
     is_active: bool = True
     valid_from: datetime
     valid_until: Optional[datetime] = None
     user_tiers: Optional[List[str]] = ["Basic", "Silver", "Gold", "Platinum"]
     description: str
 
+class ApplicableCouponsQuery(BaseModel):
+    customer_ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_CUSTOMERS)
+
+# Helper function for the current time as naive UTC, which is how PyMongo
+# stores and returns datetimes
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 # Helper function to convert ObjectId to string for JSON serialization
 def json_serialize(obj):
     if isinstance(obj, ObjectId):
@@ -58,103 +179,189 @@ def json_serialize(obj):
 # ------------------- Part 1: Coupon Management -------------------
 
 @app.post("/coupons", tags=["Coupon Management"])
-def create_coupon(coupon: CouponCreate):
+async def create_coupon(coupon: CouponCreate):
     """Create a new coupon in the system"""
-    if coupons_collection.find_one({"coupon_id": coupon.coupon_id}):
-        raise HTTPException(status_code=400, detail="Coupon ID already exists")
-    
-    coupon_dict = coupon.dict()
-    
     # Convert Pydantic model to dict for MongoDB
-    if isinstance(coupon_dict["details"], dict) and "product_ids" in coupon_dict["details"]:
-        coupon_dict["type"] = "product-wise"
-    elif isinstance(coupon_dict["details"], dict) and "threshold" in coupon_dict["details"]:
-        coupon_dict["type"] = "cart-wise"
-    elif isinstance(coupon_dict["details"], dict) and "buy_products" in coupon_dict["details"]:
-        coupon_dict["type"] = "bxgy"
-    
-    coupons_collection.insert_one(coupon_dict)
+    coupon_dict = coupon.model_dump()
+    coupon_dict["type"] = coupon_type(coupon_dict["details"])
+    
+    # The unique index on coupon_id rejects duplicates in the same round trip
+    try:
+        await coupons_collection.insert_one(coupon_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Coupon ID already exists")
+    invalidate_applicable_coupons()
     return {"message": "Coupon created successfully", "coupon_id": coupon.coupon_id}
 
 @app.get("/coupons", tags=["Coupon Management"])
-def get_all_coupons():
+async def get_all_coupons():
     """Get all coupons in the system"""
-    coupons = list(coupons_collection.find())
-    # Convert ObjectId to string for JSON serialization
-    for coupon in coupons:
-        coupon["_id"] = str(coupon["_id"])
-    return coupons
+    return await coupons_collection.find().to_list(None)
 
 @app.get("/coupons/{coupon_id}", tags=["Coupon Management"])
-def get_coupon(coupon_id: str):
+async def get_coupon(coupon_id: str):
     """Get a specific coupon by ID"""
-    coupon = coupons_collection.find_one({"coupon_id": coupon_id})
+    coupon = await coupons_collection.find_one({"coupon_id": coupon_id})
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
-    coupon["_id"] = str(coupon["_id"])
     return coupon
 
 @app.put("/coupons/{coupon_id}", tags=["Coupon Management"])
-def update_coupon(coupon_id: str, updates: Dict):
+async def update_coupon(coupon_id: str, updates: Dict):
     """Update an existing coupon"""
-    result = coupons_collection.update_one({"coupon_id": coupon_id}, {"$set": updates})
+    # Renaming onto an existing coupon_id is rejected by the same unique index
+    try:
+        result = await coupons_collection.update_one({"coupon_id": coupon_id}, {"$set": updates})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Coupon ID already exists")
+    invalidate_applicable_coupons()
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Coupon not found")
     return {"message": "Coupon updated successfully"}
 
 @app.delete("/coupons/{coupon_id}", tags=["Coupon Management"])
-def delete_coupon(coupon_id: str):
+async def delete_coupon(coupon_id: str):
     """Delete a coupon from the system"""
-    result = coupons_collection.delete_one({"coupon_id": coupon_id})
+    result = await coupons_collection.delete_one({"coupon_id": coupon_id})
+    invalidate_applicable_coupons()
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Coupon not found")
     return {"message": "Coupon deleted successfully"}
 
 # ------------------- Part 2: Customer Cart Management -------------------
 
+# Dependency that parses the customer_id path parameter once per request,
+# rejecting malformed IDs with a 400 instead of failing inside the handler
+def customer_oid(customer_id: str) -> ObjectId:
+    try:
+        return ObjectId(customer_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid customer ID")
+
+# Helper function to build the pipeline update that upserts cart lines: any
+# existing lines for the same products are dropped and the new ones appended,
+# all in a single write
+def upsert_cart_lines(cart_items: List[Dict]) -> List[Dict]:
+    product_ids = [item["product_id"] for item in cart_items]
+    return [{"$set": {"cart": {"$concatArrays": [
+        {"$filter": {
+            "input": {"$ifNull": ["$cart", []]},
+            "cond": {"$not": [{"$in": ["$$this.product_id", {"$literal": product_ids}]}]}
+        }},
+        {"$literal": cart_items}
+    ]}}}]
+
+# Helper function to validate many products with one query instead of one per item
+async def ensure_products_exist(product_ids):
+    products = await products_collection.find(
+        {"product_id": {"$in": list(product_ids)}},
+        {"_id": 0, "product_id": 1}
+    ).to_list(None)
+    missing = set(product_ids) - {product["product_id"] for product in products}
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Products not found: {', '.join(sorted(missing))}")
+
 @app.post("/customers/{customer_id}/cart", tags=["Cart Management"])
-def add_to_cart(customer_id: str, product_id: str, quantity: int, price: float):
+async def add_to_cart(product_id: str, quantity: int, price: float, oid: ObjectId = Depends(customer_oid)):
     """Add a product to customer cart"""
-    product = products_collection.find_one({"product_id": product_id})
+    # Existence check only; projecting the indexed field keeps it a covered query
+    product = await products_collection.find_one({"product_id": product_id}, {"_id": 0, "product_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
     cart_item = {
         "product_id": product_id,
         "quantity": quantity,
-        "price": price,
-        "subtotal": quantity * price
+        "price": price
     }
     
     # Update or insert the cart item
-    customers_collection.update_one(
-        {"_id": ObjectId(customer_id)},
-        {"$set": {f"cart.{product_id}": cart_item}}
-    )
+    await customers_collection.update_one({"_id": oid}, upsert_cart_lines([cart_item]))
     
     return {"message": "Product added to cart"}
 
+@app.post("/customers/{customer_id}/cart/bulk", tags=["Cart Management"])
+async def add_many_to_cart(items: List[ProductItem], oid: ObjectId = Depends(customer_oid)):
+    """Add several products to customer cart in one request"""
+    # Later entries for the same product win, as with repeated single adds
+    cart_items = {item.product_id: item.model_dump() for item in items}
+    await ensure_products_exist(cart_items)
+    
+    await customers_collection.update_one({"_id": oid}, upsert_cart_lines(list(cart_items.values())))
+    
+    return {"message": "Products added to cart", "count": len(cart_items)}
+
+@app.patch("/customers/{customer_id}/cart", tags=["Cart Management"])
+async def update_cart(changes: CartChanges, oid: ObjectId = Depends(customer_oid)):
+    """Add, update and remove several cart items in one request"""
+    add_ids = [item.product_id for item in changes.add]
+    update_ids = [item.product_id for item in changes.update]
+    product_ids = add_ids + update_ids + changes.remove
+    if not product_ids:
+        raise HTTPException(status_code=400, detail="No cart changes given")
+    # Each product may only be touched once, so the writes can run in any order
+    if len(set(product_ids)) != len(product_ids):
+        raise HTTPException(status_code=400, detail="Each product can only appear once per request")
+    
+    # Check the update targets up front: the writes are unordered, so a miss
+    # found afterwards would come after the other changes were already applied
+    if changes.update:
+        customer = await customers_collection.find_one({"_id": oid}, {"_id": 0, "cart.product_id": 1})
+        if not customer:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        missing = set(update_ids) - {line["product_id"] for line in customer.get("cart") or []}
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Products not found in cart: {', '.join(sorted(missing))}")
+    
+    operations = []
+    if changes.add:
+        await ensure_products_exist(add_ids)
+        operations.append(UpdateOne({"_id": oid}, upsert_cart_lines([item.model_dump() for item in changes.add])))
+    for item in changes.update:
+        operations.append(UpdateOne(
+            {"_id": oid, "cart.product_id": item.product_id},
+            {"$set": {"cart.$.quantity": item.quantity}}
+        ))
+    if changes.remove:
+        operations.append(UpdateOne({"_id": oid}, {"$pull": {"cart": {"product_id": {"$in": changes.remove}}}}))
+    
+    # One round trip for every change; unordered since no two writes touch the same line
+    result = await customers_collection.bulk_write(operations, ordered=False)
+    # Every write targets the one customer, so nothing matching means nothing was applied
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    
+    return {"message": "Cart updated successfully"}
+
 @app.get("/customers/{customer_id}/cart", tags=["Cart Management"])
-def get_cart(customer_id: str):
+async def get_cart(oid: ObjectId = Depends(customer_oid)):
     """Get customer's current cart"""
-    customer = customers_collection.find_one({"_id": ObjectId(customer_id)})
-    if not customer:
+    # Subtotals are not stored, so derive them and the cart total server-side
+    result = await customers_collection.aggregate([
+        {"$match": {"_id": oid}},
+        {"$project": {
+            "_id": 0,
+            "cart": {"$map": {
+                "input": {"$ifNull": ["$cart", []]},
+                "in": {"$mergeObjects": [
+                    "$$this",
+                    {"subtotal": {"$multiply": ["$$this.quantity", "$$this.price"]}}
+                ]}
+            }}
+        }},
+        {"$addFields": {"total": {"$sum": "$cart.subtotal"}}}
+    ]).to_list(1)
+    if not result:
         raise HTTPException(status_code=404, detail="Customer not found")
     
-    if "cart" not in customer or not customer["cart"]:
-        return {"cart": {}, "total": 0}
-    
-    cart = customer["cart"]
-    cart_total = sum(item["subtotal"] for item in cart.values())
-    
-    return {"cart": cart, "total": cart_total}
+    return result[0]
 
 @app.delete("/customers/{customer_id}/cart/{product_id}", tags=["Cart Management"])
-def remove_from_cart(customer_id: str, product_id: str):
+async def remove_from_cart(product_id: str, oid: ObjectId = Depends(customer_oid)):
     """Remove a product from customer cart"""
-    result = customers_collection.update_one(
-        {"_id": ObjectId(customer_id)},
-        {"$unset": {f"cart.{product_id}": ""}}
+    result = await customers_collection.update_one(
+        {"_id": oid},
+        {"$pull": {"cart": {"product_id": product_id}}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Customer not found")
@@ -162,29 +369,56 @@ def remove_from_cart(customer_id: str, product_id: str):
     return {"message": "Product removed from cart"}
 
 @app.put("/customers/{customer_id}/cart/{product_id}", tags=["Cart Management"])
-def update_cart_item(customer_id: str, product_id: str, quantity: int):
+async def update_cart_item(product_id: str, quantity: int, oid: ObjectId = Depends(customer_oid)):
     """Update the quantity of a product in the cart"""
-    customer = customers_collection.find_one({"_id": ObjectId(customer_id)})
-    if not customer or "cart" not in customer or product_id not in customer["cart"]:
-        raise HTTPException(status_code=404, detail="Product not found in cart")
-    
-    cart_item = customer["cart"][product_id]
-    cart_item["quantity"] = quantity
-    cart_item["subtotal"] = quantity * cart_item["price"]
-    
-    customers_collection.update_one(
-        {"_id": ObjectId(customer_id)},
-        {"$set": {f"cart.{product_id}": cart_item}}
+    # Matching on the line lets the read and write happen in one round trip
+    result = await customers_collection.update_one(
+        {"_id": oid, "cart.product_id": product_id},
+        {"$set": {"cart.$.quantity": quantity}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Product not found in cart")
     
     return {"message": "Cart updated successfully"}
 
 # ------------------- Part 3: Coupon Application -------------------
 
+# Helper function for the filter matching coupons that are active at the given time
+def active_coupons_filter(now):
+    return {
+        "is_active": True,
+        "valid_from": {"$lte": now},
+        "$or": [
+            {"valid_until": {"$gte": now}},
+            {"valid_until": None}
+        ]
+    }
+
+# Helper generator that streams ranked coupons as the JSON response body,
+# starting with the already fetched first result (None if there are none) and
+# caching the full ranking once the cursor is exhausted unless a coupon write
+# happened while it was being streamed
+async def stream_applicable_coupons(first, cursor, cache_key):
+    applicable_coupons = []
+    yield b'{"applicable_coupons":['
+    if first is not None:
+        yield orjson.dumps(first, default=json_serialize)
+        applicable_coupons.append(first)
+        async for coupon in cursor:
+            yield b"," + orjson.dumps(coupon, default=json_serialize)
+            applicable_coupons.append(coupon)
+    yield b"]}"
+    
+    if cache_key[-1] != applicable_coupons_generation:
+        return
+    if len(applicable_coupons_cache) >= APPLICABLE_COUPONS_CACHE_SIZE:
+        applicable_coupons_cache.clear()
+    applicable_coupons_cache[cache_key] = (time.monotonic() + APPLICABLE_COUPONS_TTL, applicable_coupons)
+
 @app.get("/customers/{customer_id}/applicable-coupons", tags=["Coupon Application"])
-def get_applicable_coupons(customer_id: str):
+async def get_applicable_coupons(limit: Optional[int] = Query(None, ge=1), oid: ObjectId = Depends(customer_oid)):
     """Get all coupons applicable to a customer's current cart"""
-    customer = customers_collection.find_one({"_id": ObjectId(customer_id)})
+    customer = await customers_collection.find_one({"_id": oid})
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
@@ -192,123 +426,107 @@ def get_applicable_coupons(customer_id: str):
     if "cart" not in customer or not customer["cart"]:
         return {"applicable_coupons": []}
     
-    cart = customer["cart"]
-    cart_items = list(cart.values())
-    cart_total = sum(item["subtotal"] for item in cart_items)
+    cart, cart_total = index_cart(customer["cart"])
     customer_tier = customer.get("tier", "Basic")
     
-    # Get all active coupons that match the customer tier
-    all_coupons = list(coupons_collection.find({
-        "is_active": True,
-        "valid_from": {"$lte": datetime.now()},
-        "$or": [
-            {"valid_until": {"$gte": datetime.now()}},
-            {"valid_until": None}
-        ],
-        "user_tiers": customer_tier
-    }))
-    
-    applicable_coupons = []
-    
-    for coupon in all_coupons:
-        coupon["_id"] = str(coupon["_id"])
-        
-        # Check each coupon type
-        if coupon["type"] == "cart-wise":
-            # Check if cart total meets threshold
-            if cart_total >= coupon["details"]["threshold"]:
-                discount = min(
-                    cart_total * (coupon["details"]["discount_percentage"] / 100),
-                    coupon["details"].get("max_discount", float('inf'))
-                )
-                coupon["calculated_discount"] = discount
-                applicable_coupons.append(coupon)
-        
-        elif coupon["type"] == "product-wise":
-            product_discount = 0
-            for product_id in coupon["details"]["product_ids"]:
-                if product_id in cart and cart[product_id]["quantity"] >= coupon["details"].get("min_quantity", 1):
-                    product_subtotal = cart[product_id]["subtotal"]
-                    product_discount += product_subtotal * (coupon["details"]["discount_percentage"] / 100)
-            
-            if product_discount > 0:
-                coupon["calculated_discount"] = product_discount
-                applicable_coupons.append(coupon)
-        
-        elif coupon["type"] == "bxgy":
-            # BxGy logic is more complex
-            eligible_buy_products = {}
-            eligible_get_products = {}
-            
-            # Count eligible products for "buy" part
-            for product_id in coupon["details"]["buy_products"]:
-                if product_id in cart:
-                    eligible_buy_products[product_id] = cart[product_id]["quantity"]
-            
-            # Count eligible products for "get" part
-            for product_id in coupon["details"]["get_products"]:
-                if product_id in cart:
-                    eligible_get_products[product_id] = {
-                        "quantity": cart[product_id]["quantity"],
-                        "price": cart[product_id]["price"]
-                    }
-            
-            if eligible_buy_products and eligible_get_products:
-                # Calculate how many "buy" units we have
-                total_buy_quantity = sum(eligible_buy_products.values())
-                buy_units = total_buy_quantity // coupon["details"]["buy_quantity"]
-                
-                # Apply repetition limit if set
-                if coupon["details"].get("repetition_limit"):
-                    buy_units = min(buy_units, coupon["details"]["repetition_limit"])
-                
-                if buy_units > 0:
-                    # Calculate how many "get" items can be discounted
-                    total_get_units = buy_units * coupon["details"]["get_quantity"]
-                    
-                    # Sort eligible "get" products by price (lowest first for maximum discount)
-                    sorted_get_products = sorted(
-                        [(pid, data["price"]) for pid, data in eligible_get_products.items()],
-                        key=lambda x: x[1]
-                    )
-                    
-                    # Calculate discount
-                    discount = 0
-                    units_discounted = 0
-                    
-                    for pid, price in sorted_get_products:
-                        available_units = eligible_get_products[pid]["quantity"]
-                        units_to_discount = min(available_units, total_get_units - units_discounted)
-                        
-                        if units_to_discount > 0:
-                            discount += units_to_discount * price * (coupon["details"]["discount_percentage"] / 100)
-                            units_discounted += units_to_discount
-                            
-                            if units_discounted >= total_get_units:
-                                break
-                    
-                    if discount > 0:
-                        coupon["calculated_discount"] = discount
-                        applicable_coupons.append(coupon)
-    
-    # Sort by discount value, highest first
-    applicable_coupons.sort(key=lambda x: x["calculated_discount"], reverse=True)
-    
-    return {"applicable_coupons": applicable_coupons}
+    # Carts are polled repeatedly while unchanged, so serve recent rankings from cache
+    cache_key = (customer_tier, frozenset(
+        (product_id, item["quantity"], item["price"]) for product_id, item in cart.items()
+    ), limit, applicable_coupons_generation)
+    cached = applicable_coupons_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return {"applicable_coupons": cached[1]}
+    
+    # Rank every active coupon for this tier inside MongoDB instead of pulling
+    # the whole coupon set into Python
+    pipeline = [
+        {"$match": {**active_coupons_filter(utcnow()), "user_tiers": customer_tier}},
+        {"$addFields": {"calculated_discount": discount_expression(cart, cart_total)}},
+        {"$match": {"calculated_discount": {"$gt": 0}}},
+        # Only ship back what the ranking response needs
+        {"$project": {"_id": 0, "coupon_id": 1, "type": 1, "calculated_discount": 1}},
+        {"$sort": {"calculated_discount": -1}}
+    ]
+    if limit:
+        pipeline.append({"$limit": limit})
+    
+    # Run the pipeline up to its first result before committing to a 200, so
+    # aggregation errors still surface as a 500 instead of a truncated body
+    cursor = aiter(coupons_collection.aggregate(pipeline))
+    first = await anext(cursor, None)
+    
+    # Stream the remaining results as the cursor yields them rather than materializing the list
+    return StreamingResponse(
+        stream_applicable_coupons(first, cursor, cache_key),
+        media_type="application/json"
+    )
+
+@app.post("/customers/applicable-coupons", tags=["Coupon Application"])
+async def get_applicable_coupons_batch(query: ApplicableCouponsQuery):
+    """Get the coupons applicable to several customers' carts in one request"""
+    try:
+        oids = {customer_id: ObjectId(customer_id) for customer_id in query.customer_ids}
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid customer ID")
+    
+    # One query for every customer instead of one request per customer
+    customers = {
+        customer["_id"]: customer
+        async for customer in customers_collection.find(
+            {"_id": {"$in": list(oids.values())}},
+            {"tier": 1, "cart": 1}
+        )
+    }
+    missing = [customer_id for customer_id, oid in oids.items() if oid not in customers]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Customers not found: {', '.join(missing)}")
+    
+    # Fetch the active coupons for every tier involved once, and parse each once
+    tiers = {customer.get("tier", "Basic") for customer in customers.values()}
+    coupons = await coupons_collection.find(
+        {**active_coupons_filter(utcnow()), "user_tiers": {"$in": list(tiers)}},
+        {"_id": 0, "coupon_id": 1, "type": 1, "details": 1, "user_tiers": 1}
+    ).to_list(None)
+    coupons = [(coupon, parse_terms(coupon)) for coupon in coupons]
+    
+    results = {}
+    for customer_id, oid in oids.items():
+        customer = customers[oid]
+        applicable_coupons = []
+        if customer.get("cart"):
+            cart, cart_total = index_cart(customer["cart"])
+            customer_tier = customer.get("tier", "Basic")
+            for coupon, terms in coupons:
+                if customer_tier not in coupon["user_tiers"]:
+                    continue
+                discount = compute_discount(terms, cart, cart_total)
+                if discount > 0:
+                    applicable_coupons.append({
+                        "coupon_id": coupon["coupon_id"],
+                        "type": coupon["type"],
+                        "calculated_discount": discount
+                    })
+            applicable_coupons.sort(key=lambda coupon: coupon["calculated_discount"], reverse=True)
+        results[customer_id] = applicable_coupons
+    
+    return results
 
 @app.post("/customers/{customer_id}/apply-coupon/{coupon_id}", tags=["Coupon Application"])
-def apply_coupon(customer_id: str, coupon_id: str):
+async def apply_coupon(coupon_id: str, oid: ObjectId = Depends(customer_oid)):
     """Apply a coupon to a customer's cart and calculate final price"""
-    customer = customers_collection.find_one({"_id": ObjectId(customer_id)})
+    # The customer and coupon lookups are independent, so overlap their round trips
+    customer, coupon = await asyncio.gather(
+        customers_collection.find_one({"_id": oid}),
+        coupons_collection.find_one({"coupon_id": coupon_id})
+    )
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
-    coupon = coupons_collection.find_one({"coupon_id": coupon_id})
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
     
     # Verify coupon is active and valid
-    now = datetime.now()
+    now = utcnow()
     if not coupon["is_active"] or coupon["valid_from"] > now:
         raise HTTPException(status_code=400, detail="Coupon is not active or not yet valid")
     
@@ -325,75 +543,8 @@ def apply_coupon(customer_id: str, coupon_id: str):
         raise HTTPException(status_code=400, detail="Cart is empty")
     
     # Recalculate the discount to ensure it's correct
-    cart = customer["cart"]
-    cart_items = list(cart.values())
-    cart_total = sum(item["subtotal"] for item in cart_items)
-    discount = 0
-    
-    # Apply discount based on coupon type
-    if coupon["type"] == "cart-wise":
-        if cart_total >= coupon["details"]["threshold"]:
-            discount = min(
-                cart_total * (coupon["details"]["discount_percentage"] / 100),
-                coupon["details"].get("max_discount", float('inf'))
-            )
-    
-    elif coupon["type"] == "product-wise":
-        for product_id in coupon["details"]["product_ids"]:
-            if product_id in cart and cart[product_id]["quantity"] >= coupon["details"].get("min_quantity", 1):
-                product_subtotal = cart[product_id]["subtotal"]
-                discount += product_subtotal * (coupon["details"]["discount_percentage"] / 100)
-    
-    elif coupon["type"] == "bxgy":
-        # BxGy logic (similar to the get_applicable_coupons function)
-        eligible_buy_products = {}
-        eligible_get_products = {}
-        
-        # Count eligible products for "buy" part
-        for product_id in coupon["details"]["buy_products"]:
-            if product_id in cart:
-                eligible_buy_products[product_id] = cart[product_id]["quantity"]
-        
-        # Count eligible products for "get" part
-        for product_id in coupon["details"]["get_products"]:
-            if product_id in cart:
-                eligible_get_products[product_id] = {
-                    "quantity": cart[product_id]["quantity"],
-                    "price": cart[product_id]["price"]
-                }
-        
-        if eligible_buy_products and eligible_get_products:
-            # Calculate how many "buy" units we have
-            total_buy_quantity = sum(eligible_buy_products.values())
-            buy_units = total_buy_quantity // coupon["details"]["buy_quantity"]
-            
-            # Apply repetition limit if set
-            if coupon["details"].get("repetition_limit"):
-                buy_units = min(buy_units, coupon["details"]["repetition_limit"])
-            
-            if buy_units > 0:
-                # Calculate how many "get" items can be discounted
-                total_get_units = buy_units * coupon["details"]["get_quantity"]
-                
-                # Sort eligible "get" products by price (lowest first for maximum discount)
-                sorted_get_products = sorted(
-                    [(pid, data["price"]) for pid, data in eligible_get_products.items()],
-                    key=lambda x: x[1]
-                )
-                
-                # Calculate discount
-                units_discounted = 0
-                
-                for pid, price in sorted_get_products:
-                    available_units = eligible_get_products[pid]["quantity"]
-                    units_to_discount = min(available_units, total_get_units - units_discounted)
-                    
-                    if units_to_discount > 0:
-                        discount += units_to_discount * price * (coupon["details"]["discount_percentage"] / 100)
-                        units_discounted += units_to_discount
-                        
-                        if units_discounted >= total_get_units:
-                            break
+    cart, cart_total = index_cart(customer["cart"])
+    discount = compute_discount(parse_terms(coupon), cart, cart_total)
     
     if discount <= 0:
         raise HTTPException(status_code=400, detail="Coupon is not applicable to your cart")
@@ -401,18 +552,6 @@ def apply_coupon(customer_id: str, coupon_id: str):
     # Calculate final price
     final_price = cart_total - discount
     
-    # Check if customer has exclusive coupons for this coupon id
-    exclusive_coupons = customer.get("exclusive_coupons", {})
-    if coupon_id in exclusive_coupons:
-        usage_limit = exclusive_coupons[coupon_id]
-        if usage_limit <= 0:
-            raise HTTPException(status_code=400, detail="You have used all your exclusive coupons of this type")
-        # Decrement usage limit
-        customers_collection.update_one(
-            {"_id": ObjectId(customer_id)},
-            {"$set": {f"exclusive_coupons.{coupon_id}": usage_limit - 1}}
-        )
-    
     # Create a discount summary
     discount_summary = {
         "coupon_id": coupon_id,
@@ -420,14 +559,29 @@ def apply_coupon(customer_id: str, coupon_id: str):
         "discount_amount": discount,
         "original_total": cart_total,
         "final_total": final_price,
-        "applied_at": datetime.now()
+        "applied_at": now
     }
     
     # Add to customer's applied coupons history
-    customers_collection.update_one(
-        {"_id": ObjectId(customer_id)},
-        {"$push": {"coupon_history": discount_summary}}
-    )
+    update_filter = {"_id": oid}
+    update = {"$push": {"coupon_history": discount_summary}}
+    
+    # Check if customer has exclusive coupons for this coupon id
+    exclusive_coupons = customer.get("exclusive_coupons", {})
+    exclusive = coupon_id in exclusive_coupons
+    if exclusive:
+        if exclusive_coupons[coupon_id] <= 0:
+            raise HTTPException(status_code=400, detail="You have used all your exclusive coupons of this type")
+        # Decrement usage limit in the same write, guarded so concurrent redemptions can't overdraw it
+        update_filter[f"exclusive_coupons.{coupon_id}"] = {"$gt": 0}
+        update["$inc"] = {f"exclusive_coupons.{coupon_id}": -1}
+    
+    result = await customers_collection.update_one(update_filter, update)
+    if result.matched_count == 0:
+        # Without the usage guard, only a customer deleted since the read misses
+        if exclusive:
+            raise HTTPException(status_code=400, detail="You have used all your exclusive coupons of this type")
+        raise HTTPException(status_code=404, detail="Customer not found")
     
     return {
         "message": "Coupon applied successfully",
@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+import heapq
+
+# Discount math shared by the coupon endpoints. compute_discount evaluates a
+# single coupon against a cart in Python; discount_expression is the same logic
+# as an aggregation expression so coupons can be ranked inside MongoDB.
+
+# Coupon details parsed once into typed terms, so the discount math reads
+# attributes instead of repeating dict lookups and defaults for every coupon.
+# Optional fields stored as None fall back to the same defaults as missing ones
+# (stored zeros are kept, as the pipeline's $ifNull does), and repeated BxGy
+# product IDs count once, so a cart line is never bought or given twice.
+@dataclass(slots=True, frozen=True)
+class CartWiseTerms:
+    threshold: float
+    discount_percentage: float
+    max_discount: float = float('inf')
+
+@dataclass(slots=True, frozen=True)
+class ProductWiseTerms:
+    product_ids: List[str]
+    discount_percentage: float
+    min_quantity: int = 1
+
+@dataclass(slots=True, frozen=True)
+class BxGyTerms:
+    buy_products: Tuple[str, ...]
+    buy_quantity: int
+    get_products: Tuple[str, ...]
+    get_quantity: int
+    discount_percentage: float = 100.0
+    repetition_limit: Optional[int] = None
+
+CouponTerms = Union[CartWiseTerms, ProductWiseTerms, BxGyTerms]
+
+# Parse a stored coupon's details into its typed terms. Returns None for an
+# unknown coupon type.
+def parse_terms(coupon: Dict) -> Optional[CouponTerms]:
+    details = coupon["details"]
+    if coupon["type"] == "cart-wise":
+        return CartWiseTerms(
+            threshold=details["threshold"],
+            discount_percentage=details["discount_percentage"],
+            max_discount=v if (v := details.get("max_discount")) is not None else float('inf')
+        )
+    elif coupon["type"] == "product-wise":
+        return ProductWiseTerms(
+            product_ids=details["product_ids"],
+            discount_percentage=details["discount_percentage"],
+            min_quantity=v if (v := details.get("min_quantity")) is not None else 1
+        )
+    elif coupon["type"] == "bxgy":
+        return BxGyTerms(
+            buy_products=tuple(dict.fromkeys(details["buy_products"])),
+            buy_quantity=details["buy_quantity"],
+            get_products=tuple(dict.fromkeys(details["get_products"])),
+            get_quantity=details["get_quantity"],
+            discount_percentage=details.get("discount_percentage", 100.0),
+            repetition_limit=details.get("repetition_limit")
+        )
+    return None
+
+# Index the stored cart lines by product_id, deriving each line's subtotal
+# (subtotals are not persisted). Returns the indexed cart and its total.
+def index_cart(lines: List[Dict]) -> Tuple[Dict, float]:
+    cart = {
+        line["product_id"]: {**line, "subtotal": line["quantity"] * line["price"]}
+        for line in lines
+    }
+    return cart, sum(item["subtotal"] for item in cart.values())
+
+# Helper function to build the aggregation expression that computes a coupon's
+# discount for the given cart. The cart is bound as two parallel literals: its
+# lines sorted by unit price (so BxGy discounts the cheapest "get" items first)
+# and their product_ids, used to look a line up by product_id.
+def discount_expression(cart: Dict, cart_total: float) -> Dict:
+    # The percentage is bound once per coupon and applied to each summed total,
+    # rather than re-evaluated for every cart line inside the $reduce loops
+    pct = "$$pct"
+    # The cart line for the product_id in $$this, or null if it is not in the cart
+    cart_line = {"$let": {
+        "vars": {"index": {"$indexOfArray": ["$$ids", "$$this"]}},
+        "in": {"$cond": [
+            {"$gte": ["$$index", 0]},
+            {"$arrayElemAt": ["$$lines", "$$index"]},
+            None
+        ]}
+    }}
+    
+    cart_wise = {"$cond": [
+        {"$gte": [cart_total, "$details.threshold"]},
+        {"$min": [
+            {"$multiply": [cart_total, pct]},
+            {"$ifNull": ["$details.max_discount", float('inf')]}
+        ]},
+        0
+    ]}
+    
+    product_wise = {"$multiply": [pct, {"$reduce": {
+        "input": "$details.product_ids",
+        "initialValue": 0,
+        "in": {"$let": {
+            "vars": {"line": cart_line},
+            "in": {"$add": ["$$value", {"$cond": [
+                {"$and": [
+                    "$$line",
+                    {"$gte": ["$$line.quantity", {"$ifNull": ["$details.min_quantity", 1]}]}
+                ]},
+                "$$line.subtotal",
+                0
+            ]}]}
+        }}
+    }}]}
+    
+    # Count eligible "buy" units, capped by the repetition limit if set. Repeated
+    # product IDs count once, and a non-positive buy_quantity (which PUT
+    # /coupons can still store) earns nothing rather than failing the $divide
+    buy_quantity = {"$reduce": {
+        "input": {"$setUnion": ["$details.buy_products"]},
+        "initialValue": 0,
+        "in": {"$add": ["$$value", {"$ifNull": [
+            {"$let": {"vars": {"line": cart_line}, "in": "$$line.quantity"}}, 0
+        ]}]}
+    }}
+    buy_units = {"$cond": [
+        {"$gt": ["$details.buy_quantity", 0]},
+        {"$floor": {"$divide": [buy_quantity, "$details.buy_quantity"]}},
+        0
+    ]}
+    buy_units = {"$cond": [
+        {"$ifNull": ["$details.repetition_limit", False]},
+        {"$min": [buy_units, "$details.repetition_limit"]},
+        buy_units
+    ]}
+    
+    # Walk the eligible "get" lines cheapest first until the free units run out
+    bxgy = {"$let": {
+        "vars": {"walk": {"$reduce": {
+            "input": {"$filter": {
+                "input": "$$lines",
+                "cond": {"$in": ["$$this.product_id", "$details.get_products"]}
+            }},
+            "initialValue": {
+                "left": {"$multiply": [buy_units, "$details.get_quantity"]},
+                "value": 0
+            },
+            "in": {"$let": {
+                "vars": {"take": {"$max": [0, {"$min": ["$$this.quantity", "$$value.left"]}]}},
+                "in": {
+                    "left": {"$subtract": ["$$value.left", "$$take"]},
+                    "value": {"$add": ["$$value.value", {"$multiply": ["$$take", "$$this.price"]}]}
+                }
+            }}
+        }}},
+        "in": {"$multiply": [pct, "$$walk.value"]}
+    }}
+    
+    lines = sorted(cart.values(), key=lambda item: item["price"])
+    return {"$let": {
+        "vars": {
+            "ids": {"$literal": [line["product_id"] for line in lines]},
+            "lines": {"$literal": lines},
+            "pct": {"$divide": ["$details.discount_percentage", 100]}
+        },
+        "in": {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$type", "cart-wise"]}, "then": cart_wise},
+                {"case": {"$eq": ["$type", "product-wise"]}, "then": product_wise},
+                {"case": {"$eq": ["$type", "bxgy"]}, "then": bxgy}
+            ],
+            "default": 0
+        }}
+    }}
+
+# Helper function for the BxGy "get" walk: discount the cheapest eligible units
+# first until total_get_units have been given away. get_lines holds one
+# (price, quantity) pair per eligible cart line.
+def bxgy_discount(get_lines: List[tuple], total_get_units: int, discount_percentage: float) -> float:
+    units_left = total_get_units
+    discounted_value = 0
+    
+    # Every line holds at least one unit, so at most total_get_units of the
+    # cheapest lines can be used; partially sort just those (lowest price first)
+    get_lines = [(price, quantity) for price, quantity in get_lines if quantity > 0]
+    for price, quantity in heapq.nsmallest(max(total_get_units, 0), get_lines):
+        if units_left <= 0:
+            break
+        units_to_discount = min(quantity, units_left)
+        discounted_value += units_to_discount * price
+        units_left -= units_to_discount
+    
+    return discounted_value * (discount_percentage / 100)
+
+# Calculate the discount a coupon gives on a cart. terms are as returned by
+# parse_terms; cart and cart_total as returned by index_cart. Returns 0 when
+# the coupon does not apply.
+def compute_discount(terms: Optional[CouponTerms], cart: Dict, cart_total: float) -> float:
+    discount = 0
+    
+    # Apply discount based on coupon type
+    if isinstance(terms, CartWiseTerms):
+        if cart_total >= terms.threshold:
+            discount = min(cart_total * (terms.discount_percentage / 100), terms.max_discount)
+    
+    elif isinstance(terms, ProductWiseTerms):
+        # Sum the eligible subtotals and apply the percentage once
+        eligible_subtotal = sum(
+            cart[product_id]["subtotal"]
+            for product_id in terms.product_ids
+            if product_id in cart and cart[product_id]["quantity"] >= terms.min_quantity
+        )
+        discount = eligible_subtotal * (terms.discount_percentage / 100)
+    
+    elif isinstance(terms, BxGyTerms):
+        # Count eligible units for the "buy" part and collect the "get" lines
+        total_buy_quantity = sum(
+            cart[product_id]["quantity"] for product_id in terms.buy_products if product_id in cart
+        )
+        get_lines = [
+            (cart[product_id]["price"], cart[product_id]["quantity"])
+            for product_id in terms.get_products if product_id in cart
+        ]
+        
+        if total_buy_quantity and get_lines and terms.buy_quantity > 0:
+            # Calculate how many "buy" units we have
+            buy_units = total_buy_quantity // terms.buy_quantity
+            
+            # Apply repetition limit if set
+            if terms.repetition_limit:
+                buy_units = min(buy_units, terms.repetition_limit)
+            
+            if buy_units > 0:
+                # Calculate how many "get" items can be discounted
+                discount = bxgy_discount(
+                    get_lines,
+                    buy_units * terms.get_quantity,
+                    terms.discount_percentage
+                )
+    
+    return discount
@@ -0,0 +1,177 @@
+import math
+from unittest.mock import AsyncMock, MagicMock
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import DeleteResult, InsertOneResult
+
+# Test doubles for the Motor collections, shared by conftest.py and the tests
+
+# Stand-in for a Motor cursor over a fixed list of documents
+class MockCursor:
+    def __init__(self, docs):
+        self.docs = docs
+    
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+    
+    async def to_list(self, length=None):
+        return list(self.docs[:length])
+
+# Dict-backed stand-in for a Motor collection whose documents are keyed by one
+# unique field. Lookups, inserts and deletes are answered from the stored
+# documents by plain coroutines and logged in `calls`, without going through
+# MagicMock. Writes MongoDB itself has to evaluate (pipeline and positional
+# updates, aggregations) stay mocks for tests to configure and inspect.
+class FakeCollection:
+    def __init__(self, key):
+        self.key = key
+        self.reset()
+    
+    # Drop all documents, calls and write mocks, then seed the given documents
+    def reset(self, docs=()):
+        self.docs = {}
+        self.calls = []
+        self.update_one = AsyncMock()
+        self.update_many = AsyncMock()
+        self.bulk_write = AsyncMock()
+        self.create_index = AsyncMock()
+        self.aggregate = MagicMock()
+        self.seed(*docs)
+    
+    # Store copies of the documents, replacing any with the same key
+    def seed(self, *docs):
+        for doc in docs:
+            self.docs[doc[self.key]] = dict(doc)
+    
+    # Filters passed to every call of the given method, in order
+    def called(self, method):
+        return [args for name, args in self.calls if name == method]
+    
+    # Only the key field is matched (by value or $in); filters on other fields
+    # match every document
+    def _matches(self, filter):
+        value = (filter or {}).get(self.key)
+        if value is None:
+            return list(self.docs.values())
+        if isinstance(value, dict):
+            return [self.docs[key] for key in value.get("$in", []) if key in self.docs]
+        return [self.docs[value]] if value in self.docs else []
+    
+    async def find_one(self, filter, projection=None):
+        self.calls.append(("find_one", filter))
+        matches = self._matches(filter)
+        return matches[0] if matches else None
+    
+    def find(self, filter=None, projection=None):
+        self.calls.append(("find", filter))
+        return MockCursor(self._matches(filter))
+    
+    async def insert_one(self, document):
+        self.calls.append(("insert_one", document))
+        if document[self.key] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error: {self.key}")
+        self.docs[document[self.key]] = document
+        return InsertOneResult(document.get("_id"), acknowledged=True)
+    
+    async def delete_one(self, filter):
+        self.calls.append(("delete_one", filter))
+        matches = self._matches(filter)[:1]
+        for doc in matches:
+            del self.docs[doc[self.key]]
+        return DeleteResult({"n": len(matches)}, acknowledged=True)
+
+# Minimal evaluator for the aggregation expression operators the app builds,
+# so pipeline expressions can be checked without a MongoDB server. Missing
+# fields and null are both None; truthiness follows MongoDB (only false, null,
+# missing and 0 are false).
+def _truthy(value):
+    return value is not None and value is not False and not (isinstance(value, (int, float)) and value == 0)
+
+# BSON comparison order for the values used here: null sorts below numbers
+def _sort_key(value):
+    return (0, 0) if value is None else (1, value)
+
+def _path(value, fields):
+    for field in fields:
+        value = value.get(field) if isinstance(value, dict) else None
+    return value
+
+def evaluate(expr, doc, variables=None):
+    variables = variables or {}
+    def ev(e, v=None):
+        return evaluate(e, doc, {**variables, **(v or {})})
+    
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, *fields = expr[2:].split(".")
+        return _path(variables[name], fields)
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _path(doc, expr[1:].split("."))
+    if isinstance(expr, list):
+        return [ev(item) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if not expr or not next(iter(expr)).startswith("$"):
+        return {key: ev(value) for key, value in expr.items()}
+    
+    (op, args), = expr.items()
+    if op == "$literal":
+        return args
+    if op == "$let":
+        return ev(args["in"], {name: ev(value) for name, value in args["vars"].items()})
+    if op == "$cond":
+        condition, then, otherwise = args
+        return ev(then) if _truthy(ev(condition)) else ev(otherwise)
+    if op == "$switch":
+        for branch in args["branches"]:
+            if _truthy(ev(branch["case"])):
+                return ev(branch["then"])
+        return ev(args["default"])
+    if op == "$and":
+        return all(_truthy(ev(arg)) for arg in args)
+    if op == "$ifNull":
+        value = ev(args[0])
+        return ev(args[1]) if value is None else value
+    if op == "$reduce":
+        items = ev(args["input"])
+        if items is None:
+            return None
+        value = ev(args["initialValue"])
+        for item in items:
+            value = ev(args["in"], {"this": item, "value": value})
+        return value
+    if op == "$filter":
+        items = ev(args["input"])
+        name = args.get("as", "this")
+        return [item for item in items if _truthy(ev(args["cond"], {name: item}))]
+    if op == "$min" or op == "$max":
+        values = [value for value in ev(args) if value is not None]
+        return (min if op == "$min" else max)(values) if values else None
+    
+    values = ev(args) if isinstance(args, list) else [ev(args)]
+    if op == "$eq":
+        return values[0] == values[1]
+    if op == "$gt":
+        return _sort_key(values[0]) > _sort_key(values[1])
+    if op == "$gte":
+        return _sort_key(values[0]) >= _sort_key(values[1])
+    if op == "$setUnion":
+        return list(dict.fromkeys(item for items in values for item in items))
+    if op == "$in":
+        return values[0] in values[1]
+    if op == "$indexOfArray":
+        return values[0].index(values[1]) if values[1] in values[0] else -1
+    if op == "$arrayElemAt":
+        return values[0][values[1]] if -len(values[0]) <= values[1] < len(values[0]) else None
+    if None in values:
+        return None  # Arithmetic on null is null
+    if op == "$add":
+        return sum(values)
+    if op == "$subtract":
+        return values[0] - values[1]
+    if op == "$multiply":
+        return math.prod(values)
+    if op == "$divide":
+        return values[0] / values[1]
+    if op == "$floor":
+        return math.floor(values[0])
+    raise NotImplementedError(op)
@@ -0,0 +1,92 @@
+from bson import ObjectId
+from datetime import datetime, timedelta
+from types import MappingProxyType
+
+# Mock data shared by the test modules. The app's clock is frozen at _NOW for
+# the whole session (see conftest.py) and every date is derived from it once at
+# import. Only the top level of each document is a read-only view; nested
+# values such as details, cart and user_tiers are shared mutable objects, and
+# the fake collections store shallow copies, so tests must never mutate them.
+# Build variants by merging instead, e.g. {**doc, "valid_until": ...} or, for
+# nested fields, {**doc, "details": {**doc["details"], "threshold": ...}}.
+_NOW = datetime(2024, 1, 15)
+
+mock_customer_id = "60d21b4667d0d8992e610c85"
+unknown_customer_id = "60d21b4667d0d8992e610c99"  # Valid ObjectId that no customer has
+mock_product_id = "p123"
+mock_coupon_id = "WELCOME10"
+
+# Parsed once rather than on every lookup and assertion
+_CUST_OID = ObjectId(mock_customer_id)
+
+# Mock coupon data
+mock_cart_coupon = MappingProxyType({
+    "coupon_id": "CART20",
+    "type": "cart-wise",
+    "details": {
+        "threshold": 100.0,
+        "discount_percentage": 20.0,
+        "max_discount": 50.0
+    },
+    "is_active": True,
+    "valid_from": _NOW - timedelta(days=10),
+    "valid_until": _NOW + timedelta(days=20),
+    "user_tiers": ["Basic", "Silver", "Gold", "Platinum"],
+    "description": "20% off on orders above $100, max discount $50"
+})
+
+mock_product_coupon = MappingProxyType({
+    "coupon_id": "PROD15",
+    "type": "product-wise",
+    "details": {
+        "product_ids": ["p123", "p456"],
+        "discount_percentage": 15.0,
+        "min_quantity": 2
+    },
+    "is_active": True,
+    "valid_from": _NOW - timedelta(days=5),
+    "valid_until": None,
+    "user_tiers": ["Basic", "Silver", "Gold", "Platinum"],
+    "description": "15% off on selected products"
+})
+
+mock_bxgy_coupon = MappingProxyType({
+    "coupon_id": "BUY2GET1",
+    "type": "bxgy",
+    "details": {
+        "buy_products": ["p123", "p456"],
+        "buy_quantity": 2,
+        "get_products": ["p789"],
+        "get_quantity": 1,
+        "discount_percentage": 100.0,
+        "repetition_limit": 1
+    },
+    "is_active": True,
+    "valid_from": _NOW - timedelta(days=2),
+    "valid_until": _NOW + timedelta(days=30),
+    "user_tiers": ["Silver", "Gold", "Platinum"],
+    "description": "Buy 2, Get 1 Free"
+})
+
+mock_customer = MappingProxyType({
+    "_id": _CUST_OID,
+    "name": "Test User",
+    "email": "test@example.com",
+    "tier": "Silver",
+    "cart": [
+        {"product_id": "p123", "quantity": 2, "price": 50.0},
+        {"product_id": "p456", "quantity": 1, "price": 30.0},
+        {"product_id": "p789", "quantity": 1, "price": 20.0}
+    ],
+    "exclusive_coupons": {
+        "EXCLUSIVE10": 2
+    },
+    "coupon_history": []
+})
+
+mock_product = MappingProxyType({
+    "product_id": mock_product_id,
+    "name": "Test Product",
+    "price": 50.0,
+    "stock": 100
+})
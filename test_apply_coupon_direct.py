@@ -0,0 +1,41 @@
+import pytest
+from fastapi import HTTPException
+
+from coupons import apply_coupon
+from mock_data import _CUST_OID, mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon
+
+# Coupon application logic tested by awaiting the route function directly,
+# skipping routing, validation and JSON encoding. The HTTP contract, including
+# the missing, expired and wrong-tier rejections, is covered by the TestClient
+# tests in unit_test.py.
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("coupon,expected_discount,expected_final", [
+    (mock_cart_coupon, 30.0, 120.0),  # 20% of 150, capped at 50
+    (mock_product_coupon, 15.0, 135.0),  # 15% of 100 (product p123)
+    (mock_bxgy_coupon, 20.0, 130.0)  # 100% off on product p789
+], ids=["cart", "product", "bxgy"])
+async def test_apply_coupon(mock_db_connections, coupon, expected_discount, expected_final):
+    mock_customers, _, _ = mock_db_connections
+    
+    result = await apply_coupon(coupon_id=coupon["coupon_id"], oid=_CUST_OID)
+    
+    assert result["discount_amount"] == expected_discount
+    assert result["original_total"] == 150.0
+    assert result["final_total"] == expected_final
+    update_filter, update = mock_customers.update_one.call_args[0]
+    assert update_filter == {"_id": _CUST_OID}
+    assert update["$push"]["coupon_history"]["coupon_type"] == coupon["type"]
+
+
+async def test_apply_coupon_below_threshold(mock_db_connections):
+    mock_customers, _, mock_coupons = mock_db_connections
+    mock_coupons.seed({**mock_cart_coupon, "details": {**mock_cart_coupon["details"], "threshold": 500.0}})
+    
+    with pytest.raises(HTTPException) as error:
+        await apply_coupon(coupon_id=mock_cart_coupon["coupon_id"], oid=_CUST_OID)
+    
+    assert error.value.status_code == 400
+    assert "not applicable" in error.value.detail
+    mock_customers.update_one.assert_not_called()
@@ -0,0 +1,56 @@
+import pytest
+
+from discounts import compute_discount, discount_expression, index_cart, parse_terms
+from fake_mongo import evaluate
+from mock_data import mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon, mock_customer
+
+# The ranking pipeline (discount_expression) and apply_coupon (compute_discount)
+# must agree on every coupon, so each case is evaluated both ways.
+
+CARTS = {
+    "mock": list(mock_customer["cart"]),
+    "bulk": [
+        {"product_id": "p123", "quantity": 5, "price": 50.0},
+        {"product_id": "p456", "quantity": 3, "price": 30.0},
+        {"product_id": "p789", "quantity": 4, "price": 20.0},
+        {"product_id": "p999", "quantity": 2, "price": 5.0}
+    ],
+    "unrelated": [{"product_id": "p999", "quantity": 1, "price": 5.0}]
+}
+
+COUPONS = {
+    "cart": mock_cart_coupon,
+    "cart-uncapped": {**mock_cart_coupon, "details": {**mock_cart_coupon["details"], "max_discount": None}},
+    "cart-zero-cap": {**mock_cart_coupon, "details": {**mock_cart_coupon["details"], "max_discount": 0}},
+    "product": mock_product_coupon,
+    "product-any-quantity": {**mock_product_coupon, "details": {**mock_product_coupon["details"], "min_quantity": None}},
+    "product-zero-quantity": {**mock_product_coupon, "details": {**mock_product_coupon["details"], "min_quantity": 0}},
+    "bxgy": mock_bxgy_coupon,
+    "bxgy-twice": {**mock_bxgy_coupon, "details": {**mock_bxgy_coupon["details"], "repetition_limit": 2}},
+    "bxgy-unlimited": {**mock_bxgy_coupon, "details": {**mock_bxgy_coupon["details"], "repetition_limit": None}},
+    "bxgy-repeated-get": {**mock_bxgy_coupon, "details": {
+        **mock_bxgy_coupon["details"], "buy_quantity": 1, "get_products": ["p789", "p789"], "repetition_limit": None
+    }},
+    "bxgy-repeated-buy": {**mock_bxgy_coupon, "details": {
+        **mock_bxgy_coupon["details"], "buy_products": ["p123", "p123"], "repetition_limit": None
+    }},
+    "bxgy-zero-buy-quantity": {**mock_bxgy_coupon, "details": {**mock_bxgy_coupon["details"], "buy_quantity": 0}}
+}
+
+
+@pytest.mark.parametrize("lines", CARTS.values(), ids=CARTS.keys())
+@pytest.mark.parametrize("coupon", COUPONS.values(), ids=COUPONS.keys())
+def test_pipeline_matches_compute_discount(coupon, lines):
+    cart, cart_total = index_cart(lines)
+    
+    expected = compute_discount(parse_terms(coupon), cart, cart_total)
+    
+    assert evaluate(discount_expression(cart, cart_total), dict(coupon)) == pytest.approx(expected)
+
+
+# Stored zeros are real values, not "unset": a zero cap gives no discount
+def test_zero_max_discount_caps_at_zero():
+    cart, cart_total = index_cart(list(mock_customer["cart"]))
+    coupon = {**mock_cart_coupon, "details": {**mock_cart_coupon["details"], "max_discount": 0}}
+    
+    assert compute_discount(parse_terms(coupon), cart, cart_total) == 0
@@ -1,240 +1,165 @@
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock
 from bson import ObjectId
-from datetime import datetime, timedelta
-import json
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from datetime import timedelta
+import asyncio
+import orjson
 
-# Import the main app
-from main import app
+import coupons
+from coupons import MAX_BATCH_CUSTOMERS, delete_coupon, get_applicable_coupons
+from fake_mongo import MockCursor
+from mock_data import (
+    _NOW, _CUST_OID, mock_customer_id, unknown_customer_id, mock_product_id,
+    mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon, mock_customer, mock_product
+)
 
-# Create test client
-client = TestClient(app)
+_JSON_HDR = {"content-type": "application/json", "accept": "application/json"}
 
-# Mock data for tests
-mock_customer_id = "60d21b4667d0d8992e610c85"
-mock_product_id = "p123"
-mock_coupon_id = "WELCOME10"
+# Send an already serialized JSON body through a request built up front,
+# skipping the client's per-call json encoding and keyword handling
+def send_json(client, method, url, body):
+    return client.send(client.build_request(method, url, content=body, headers=_JSON_HDR))
 
-# Mock coupon data
-mock_cart_coupon = {
-    "coupon_id": "CART20",
-    "type": "cart-wise",
-    "details": {
-        "threshold": 100.0,
-        "discount_percentage": 20.0,
-        "max_discount": 50.0
-    },
-    "is_active": True,
-    "valid_from": datetime.now() - timedelta(days=10),
-    "valid_until": datetime.now() + timedelta(days=20),
-    "user_tiers": ["Basic", "Silver", "Gold", "Platinum"],
-    "description": "20% off on orders above $100, max discount $50"
-}
+# Coupon request bodies, serialized once at import and sent as raw bytes
 
-mock_product_coupon = {
-    "coupon_id": "PROD15",
-    "type": "product-wise",
+_CREATE_BODY = orjson.dumps({
+    "coupon_id": "NEW10",
+    "type": "cart-wise",
     "details": {
-        "product_ids": ["p123", "p456"],
-        "discount_percentage": 15.0,
-        "min_quantity": 2
+        "threshold": 50.0,
+        "discount_percentage": 10.0
     },
     "is_active": True,
-    "valid_from": datetime.now() - timedelta(days=5),
-    "valid_until": None,
-    "user_tiers": ["Basic", "Silver", "Gold", "Platinum"],
-    "description": "15% off on selected products"
-}
+    "valid_from": _NOW,
+    "description": "10% off on orders above $50"
+})
 
-mock_bxgy_coupon = {
-    "coupon_id": "BUY2GET1",
-    "type": "bxgy",
+_DUPLICATE_BODY = orjson.dumps({
+    "coupon_id": mock_cart_coupon["coupon_id"],
+    "type": "cart-wise",
     "details": {
-        "buy_products": ["p123", "p456"],
-        "buy_quantity": 2,
-        "get_products": ["p789"],
-        "get_quantity": 1,
-        "discount_percentage": 100.0,
-        "repetition_limit": 1
+        "threshold": 50.0,
+        "discount_percentage": 10.0
     },
     "is_active": True,
-    "valid_from": datetime.now() - timedelta(days=2),
-    "valid_until": datetime.now() + timedelta(days=30),
-    "user_tiers": ["Silver", "Gold", "Platinum"],
-    "description": "Buy 2, Get 1 Free"
-}
+    "valid_from": _NOW,
+    "description": "Duplicate coupon"
+})
 
-mock_customer = {
-    "_id": ObjectId(mock_customer_id),
-    "name": "Test User",
-    "email": "test@example.com",
-    "tier": "Silver",
-    "cart": {
-        "p123": {"product_id": "p123", "quantity": 2, "price": 50.0, "subtotal": 100.0},
-        "p456": {"product_id": "p456", "quantity": 1, "price": 30.0, "subtotal": 30.0},
-        "p789": {"product_id": "p789", "quantity": 1, "price": 20.0, "subtotal": 20.0}
-    },
-    "exclusive_coupons": {
-        "EXCLUSIVE10": 2
-    },
-    "coupon_history": []
-}
-
-mock_product = {
-    "product_id": mock_product_id,
-    "name": "Test Product",
-    "price": 50.0,
-    "stock": 100
-}
-
-# Setup patches for MongoDB collections
-@pytest.fixture(autouse=True)
-def mock_db_connections():
-    with patch('main.customers_collection') as mock_customers, \
-         patch('main.products_collection') as mock_products, \
-         patch('main.coupons_collection') as mock_coupons:
-        
-        # Set up mock returns
-        mock_customers.find_one.side_effect = lambda filter: mock_customer if filter.get("_id") == ObjectId(mock_customer_id) else None
-        mock_products.find_one.side_effect = lambda filter: mock_product if filter.get("product_id") == mock_product_id else None
-        
-        # For coupons
-        def find_one_coupon(filter):
-            if filter.get("coupon_id") == mock_cart_coupon["coupon_id"]:
-                return mock_cart_coupon
-            elif filter.get("coupon_id") == mock_product_coupon["coupon_id"]:
-                return mock_product_coupon
-            elif filter.get("coupon_id") == mock_bxgy_coupon["coupon_id"]:
-                return mock_bxgy_coupon
-            return None
-            
-        mock_coupons.find_one.side_effect = find_one_coupon
-        mock_coupons.find.return_value = [mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon]
-        
-        yield mock_customers, mock_products, mock_coupons
+_UPDATE_BODY = orjson.dumps({"is_active": False})
 
 
 # ------------------------ Part 1: Coupon Management Tests ------------------------
 
+@pytest.mark.usefixtures("mock_db_connections")
 class TestCouponManagement:
-    def test_create_coupon(self, mock_db_connections):
+    def test_create_coupon(self, client, mock_db_connections):
         _, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = None  # No coupon exists yet
         
-        response = client.post(
-            "/coupons",
-            json={
-                "coupon_id": "NEW10",
-                "type": "cart-wise",
-                "details": {
-                    "threshold": 50.0,
-                    "discount_percentage": 10.0
-                },
-                "is_active": True,
-                "valid_from": datetime.now().isoformat(),
-                "description": "10% off on orders above $50"
-            }
-        )
+        response = send_json(client, "POST", "/coupons", _CREATE_BODY)
         
         assert response.status_code == 200
         assert response.json()["message"] == "Coupon created successfully"
         assert response.json()["coupon_id"] == "NEW10"
-        mock_coupons.insert_one.assert_called_once()
+        assert "NEW10" in mock_coupons.docs
+        assert not mock_coupons.called("find_one")  # Uniqueness is enforced by the index
     
-    def test_create_duplicate_coupon(self, mock_db_connections):
+    def test_create_duplicate_coupon(self, client, mock_db_connections):
         _, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = mock_cart_coupon  # Coupon already exists
         
-        response = client.post(
-            "/coupons",
-            json={
-                "coupon_id": mock_cart_coupon["coupon_id"],
-                "type": "cart-wise",
-                "details": {
-                    "threshold": 50.0,
-                    "discount_percentage": 10.0
-                },
-                "is_active": True,
-                "valid_from": datetime.now().isoformat(),
-                "description": "Duplicate coupon"
-            }
-        )
+        response = send_json(client, "POST", "/coupons", _DUPLICATE_BODY)
         
         assert response.status_code == 400
         assert "already exists" in response.json()["detail"]
     
-    def test_get_all_coupons(self, mock_db_connections):
+    @pytest.mark.parametrize("details", [
+        {"discount_percentage": 10.0},  # Matches no coupon type
+        "foo",
+        None
+    ], ids=["no-type", "string", "null"])
+    def test_create_coupon_invalid_details(self, client, mock_db_connections, details):
         _, _, mock_coupons = mock_db_connections
-        # Convert ObjectId to string for each coupon
-        for coupon in [mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon]:
-            coupon["_id"] = str(ObjectId())
-            
+        
+        response = send_json(client, "POST", "/coupons", orjson.dumps({
+            "coupon_id": "BAD10",
+            "type": "cart-wise",
+            "details": details,
+            "valid_from": _NOW,
+            "description": "Details match no coupon type"
+        }))
+        
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["type"] == "invalid_coupon_details"
+    
+    def test_create_bxgy_coupon_zero_buy_quantity(self, client, mock_db_connections):
+        _, _, mock_coupons = mock_db_connections
+        
+        response = send_json(client, "POST", "/coupons", orjson.dumps({
+            "coupon_id": "BUY0",
+            "type": "bxgy",
+            "details": {**mock_bxgy_coupon["details"], "buy_quantity": 0},
+            "valid_from": _NOW,
+            "description": "Buy nothing, get one free"
+        }))
+        
+        assert response.status_code == 422
+        assert "BUY0" not in mock_coupons.docs
+        assert not mock_coupons.called("insert_one")
+    
+    def test_get_all_coupons(self, client):
         response = client.get("/coupons")
         
         assert response.status_code == 200
         assert len(response.json()) == 3
     
-    def test_get_coupon_by_id(self, mock_db_connections):
-        _, _, mock_coupons = mock_db_connections
-        mock_cart_coupon["_id"] = str(ObjectId())
-        mock_coupons.find_one.return_value = mock_cart_coupon
-        
+    def test_get_coupon_by_id(self, client):
         response = client.get(f"/coupons/{mock_cart_coupon['coupon_id']}")
         
         assert response.status_code == 200
         assert response.json()["coupon_id"] == mock_cart_coupon["coupon_id"]
         assert response.json()["type"] == "cart-wise"
     
-    def test_get_nonexistent_coupon(self, mock_db_connections):
-        _, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = None
-        
-        response = client.get("/coupons/NONEXISTENT")
-        
-        assert response.status_code == 404
-        assert "not found" in response.json()["detail"]
-    
-    def test_update_coupon(self, mock_db_connections):
+    def test_update_coupon(self, client, mock_db_connections):
         _, _, mock_coupons = mock_db_connections
         mock_coupons.update_one.return_value = MagicMock(matched_count=1)
         
-        response = client.put(
-            f"/coupons/{mock_cart_coupon['coupon_id']}",
-            json={"is_active": False}
-        )
+        response = send_json(client, "PUT", f"/coupons/{mock_cart_coupon['coupon_id']}", _UPDATE_BODY)
         
         assert response.status_code == 200
         assert response.json()["message"] == "Coupon updated successfully"
         mock_coupons.update_one.assert_called_once()
     
-    def test_update_nonexistent_coupon(self, mock_db_connections):
+    def test_update_coupon_to_existing_id(self, client, mock_db_connections):
         _, _, mock_coupons = mock_db_connections
-        mock_coupons.update_one.return_value = MagicMock(matched_count=0)
+        mock_coupons.update_one.side_effect = DuplicateKeyError("E11000 duplicate key error: coupon_id")
         
-        response = client.put(
-            "/coupons/NONEXISTENT",
-            json={"is_active": False}
-        )
+        response = send_json(client, "PUT", f"/coupons/{mock_cart_coupon['coupon_id']}", orjson.dumps(
+            {"coupon_id": mock_product_coupon["coupon_id"]}
+        ))
         
-        assert response.status_code == 404
-        assert "not found" in response.json()["detail"]
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Coupon ID already exists"
     
-    def test_delete_coupon(self, mock_db_connections):
+    def test_delete_coupon(self, client, mock_db_connections):
         _, _, mock_coupons = mock_db_connections
-        mock_coupons.delete_one.return_value = MagicMock(deleted_count=1)
         
         response = client.delete(f"/coupons/{mock_cart_coupon['coupon_id']}")
         
         assert response.status_code == 200
         assert response.json()["message"] == "Coupon deleted successfully"
-        mock_coupons.delete_one.assert_called_once()
+        assert mock_cart_coupon["coupon_id"] not in mock_coupons.docs
     
-    def test_delete_nonexistent_coupon(self, mock_db_connections):
+    @pytest.mark.parametrize("method,body", [
+        ("GET", None),
+        ("PUT", _UPDATE_BODY),
+        ("DELETE", None)
+    ], ids=["get", "update", "delete"])
+    def test_nonexistent_coupon(self, client, mock_db_connections, method, body):
         _, _, mock_coupons = mock_db_connections
-        mock_coupons.delete_one.return_value = MagicMock(deleted_count=0)
+        mock_coupons.update_one.return_value = MagicMock(matched_count=0)
         
-        response = client.delete("/coupons/NONEXISTENT")
+        response = send_json(client, method, "/coupons/NONEXISTENT", body)
         
         assert response.status_code == 404
         assert "not found" in response.json()["detail"]
@@ -242,27 +167,45 @@ class TestCouponManagement:
 
 # ------------------------ Part 2: Cart Management Tests ------------------------
 
+@pytest.mark.usefixtures("mock_db_connections")
 class TestCartManagement:
-    def test_add_to_cart(self, mock_db_connections):
-        mock_customers, mock_products, _ = mock_db_connections
-        
-        response = client.post(
-            f"/customers/{mock_customer_id}/cart",
-            params={
-                "product_id": mock_product_id,
-                "quantity": 3,
-                "price": 50.0
-            }
-        )
-        
-        assert response.status_code == 200
-        assert response.json()["message"] == "Product added to cart"
-        mock_customers.update_one.assert_called_once()
+    # One pass through a cart's lifecycle, one request per step:
+    # (method, path, query params, expected message; None for the cart read)
+    CART_FLOW = [
+        ("POST", f"/customers/{mock_customer_id}/cart", {"product_id": mock_product_id, "quantity": 3, "price": 50.0}, "Product added to cart"),
+        ("GET", f"/customers/{mock_customer_id}/cart", None, None),
+        ("PUT", f"/customers/{mock_customer_id}/cart/{mock_product_id}", {"quantity": 5}, "Cart updated successfully"),
+        ("DELETE", f"/customers/{mock_customer_id}/cart/{mock_product_id}", None, "Product removed from cart")
+    ]
     
-    def test_add_nonexistent_product(self, mock_db_connections):
-        _, mock_products, _ = mock_db_connections
-        mock_products.find_one.return_value = None
-        
+    def test_cart_flow(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        mock_customers.update_one.return_value = MagicMock(matched_count=1)
+        # Subtotals and the total are derived by the aggregation
+        mock_customers.aggregate.return_value = MockCursor([{
+            "cart": [{**item, "subtotal": item["quantity"] * item["price"]} for item in mock_customer["cart"]],
+            "total": 150.0
+        }])
+        
+        for method, url, params, message in self.CART_FLOW:
+            response = client.request(method, url, params=params)
+            
+            assert response.status_code == 200, (method, url)
+            if message:
+                assert response.json()["message"] == message
+            else:
+                assert response.json()["total"] == 150.0  # Sum of all subtotals
+        
+        # Every write is a single update_one on the customer, without a read first
+        updates = [call.args for call in mock_customers.update_one.call_args_list]
+        assert [update_filter["_id"] for update_filter, _ in updates] == [_CUST_OID] * 3
+        assert isinstance(updates[0][1], list)  # Upsert pipeline
+        assert updates[1][1] == {"$set": {"cart.$.quantity": 5}}
+        assert updates[2][1] == {"$pull": {"cart": {"product_id": mock_product_id}}}
+        assert mock_customers.aggregate.call_args[0][0][0] == {"$match": {"_id": _CUST_OID}}
+        assert not mock_customers.called("find_one")
+    
+    def test_add_nonexistent_product(self, client):
         response = client.post(
             f"/customers/{mock_customer_id}/cart",
             params={
@@ -275,64 +218,120 @@ class TestCartManagement:
         assert response.status_code == 404
         assert "Product not found" in response.json()["detail"]
     
-    def test_get_cart(self, mock_db_connections):
-        mock_customers, _, _ = mock_db_connections
+    def test_add_many_to_cart(self, client, mock_db_connections):
+        mock_customers, mock_products, _ = mock_db_connections
+        mock_products.seed({**mock_product, "product_id": "p456"})
         
-        response = client.get(f"/customers/{mock_customer_id}/cart")
+        response = send_json(client, "POST", f"/customers/{mock_customer_id}/cart/bulk", orjson.dumps([
+            {"product_id": "p123", "quantity": 1, "price": 50.0},
+            {"product_id": "p456", "quantity": 2, "price": 30.0}
+        ]))
         
         assert response.status_code == 200
-        assert "cart" in response.json()
-        assert "total" in response.json()
-        assert response.json()["total"] == 150.0  # Sum of all subtotals
+        assert response.json()["count"] == 2
+        assert len(mock_products.called("find")) == 1
+        assert not mock_products.called("find_one")
+        mock_customers.update_one.assert_called_once()
     
-    def test_get_cart_nonexistent_customer(self, mock_db_connections):
+    def test_add_many_with_nonexistent_product(self, client, mock_db_connections):
         mock_customers, _, _ = mock_db_connections
-        mock_customers.find_one.return_value = None
         
-        response = client.get("/customers/nonexistent/cart")
+        response = send_json(client, "POST", f"/customers/{mock_customer_id}/cart/bulk", orjson.dumps([
+            {"product_id": "p123", "quantity": 1, "price": 50.0},
+            {"product_id": "nonexistent", "quantity": 1, "price": 10.0}
+        ]))
         
         assert response.status_code == 404
-        assert "Customer not found" in response.json()["detail"]
+        assert "nonexistent" in response.json()["detail"]
+        mock_customers.update_one.assert_not_called()
     
-    def test_remove_from_cart(self, mock_db_connections):
+    def test_update_cart_in_bulk(self, client, mock_db_connections):
         mock_customers, _, _ = mock_db_connections
-        mock_customers.update_one.return_value = MagicMock(matched_count=1)
+        mock_customers.bulk_write.return_value = MagicMock(matched_count=3)
         
-        response = client.delete(f"/customers/{mock_customer_id}/cart/{mock_product_id}")
+        response = send_json(client, "PATCH", f"/customers/{mock_customer_id}/cart", orjson.dumps({
+            "add": [{"product_id": mock_product_id, "quantity": 1, "price": 50.0}],
+            "update": [{"product_id": "p456", "quantity": 3}],
+            "remove": ["p789"]
+        }))
         
         assert response.status_code == 200
-        assert response.json()["message"] == "Product removed from cart"
-        mock_customers.update_one.assert_called_once()
+        assert response.json()["message"] == "Cart updated successfully"
+        operations = mock_customers.bulk_write.call_args[0][0]
+        assert len(operations) == 3
+        assert mock_customers.bulk_write.call_args[1] == {"ordered": False}
+        mock_customers.update_one.assert_not_called()
     
-    def test_update_cart_item(self, mock_db_connections):
+    # Missing update targets are found before anything is written
+    @pytest.mark.parametrize("customer_id, detail", [
+        (mock_customer_id, "Products not found in cart: nonexistent"),
+        (unknown_customer_id, "Customer not found")
+    ], ids=["product_not_in_cart", "customer_not_found"])
+    def test_update_cart_in_bulk_not_found(self, client, mock_db_connections, customer_id, detail):
         mock_customers, _, _ = mock_db_connections
         
-        response = client.put(
-            f"/customers/{mock_customer_id}/cart/{mock_product_id}",
-            params={"quantity": 5}
-        )
+        response = send_json(client, "PATCH", f"/customers/{customer_id}/cart", orjson.dumps({
+            "add": [{"product_id": mock_product_id, "quantity": 1, "price": 50.0}],
+            "update": [{"product_id": "nonexistent", "quantity": 3}],
+            "remove": ["p789"]
+        }))
         
-        assert response.status_code == 200
-        assert response.json()["message"] == "Cart updated successfully"
-        mock_customers.update_one.assert_called_once()
+        assert response.status_code == 404
+        assert response.json()["detail"] == detail
+        mock_customers.bulk_write.assert_not_called()
+    
+    def test_update_cart_in_bulk_unknown_customer(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        mock_customers.bulk_write.return_value = MagicMock(matched_count=0)
+        
+        response = send_json(client, "PATCH", f"/customers/{unknown_customer_id}/cart", orjson.dumps(
+            {"remove": ["p789"]}
+        ))
+        
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Customer not found"
+    
+    def test_update_cart_in_bulk_rejects_repeated_product(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        
+        response = send_json(client, "PATCH", f"/customers/{mock_customer_id}/cart", orjson.dumps(
+            {"update": [{"product_id": "p456", "quantity": 3}], "remove": ["p456"]}
+        ))
+        
+        assert response.status_code == 400
+        mock_customers.bulk_write.assert_not_called()
+    
+    def test_get_cart_nonexistent_customer(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        mock_customers.aggregate.return_value = MockCursor([])
+        
+        response = client.get(f"/customers/{unknown_customer_id}/cart")
+        
+        assert response.status_code == 404
+        assert "Customer not found" in response.json()["detail"]
+    
+    def test_get_cart_malformed_customer_id(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        
+        response = client.get("/customers/nonexistent/cart")
+        
+        assert response.status_code == 400
+        assert "Invalid customer ID" in response.json()["detail"]
+        mock_customers.aggregate.assert_not_called()
 
 
 # ------------------------ Part 3: Coupon Application Tests ------------------------
 
+@pytest.mark.usefixtures("mock_db_connections")
 class TestCouponApplication:
-    @patch('main.datetime')
-    def test_get_applicable_coupons(self, mock_datetime, mock_db_connections):
+    def test_get_applicable_coupons(self, client, mock_db_connections):
         mock_customers, _, mock_coupons = mock_db_connections
-        mock_datetime.now.return_value = datetime.now()
         
-        # Convert ObjectIds to strings
-        for coupon in [mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon]:
-            coupon["_id"] = str(ObjectId())
-        
-        def mock_find(*args, **kwargs):
-            return [mock_cart_coupon, mock_product_coupon, mock_bxgy_coupon]
-        
-        mock_coupons.find.side_effect = mock_find
+        # Discounts are ranked server-side, so the aggregation returns them pre-sorted
+        mock_coupons.aggregate.return_value = MockCursor([
+            {**mock_cart_coupon, "calculated_discount": 30.0},
+            {**mock_product_coupon, "calculated_discount": 15.0}
+        ])
         
         response = client.get(f"/customers/{mock_customer_id}/applicable-coupons")
         
@@ -343,73 +342,181 @@ class TestCouponApplication:
         coupon_types = {coupon["type"] for coupon in response.json()["applicable_coupons"]}
         assert "cart-wise" in coupon_types
         assert "product-wise" in coupon_types
+        
+        # The tier filter and ranking are pushed into the pipeline
+        pipeline = mock_coupons.aggregate.call_args[0][0]
+        assert pipeline[0]["$match"]["user_tiers"] == "Silver"
+        assert pipeline[-2] == {"$project": {"_id": 0, "coupon_id": 1, "type": 1, "calculated_discount": 1}}
+        assert pipeline[-1] == {"$sort": {"calculated_discount": -1}}
+        assert not mock_coupons.called("find")
     
-    def test_apply_cart_coupon(self, mock_db_connections):
-        mock_customers, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = mock_cart_coupon
+    def test_get_applicable_coupons_with_limit(self, client, mock_db_connections):
+        _, _, mock_coupons = mock_db_connections
+        mock_coupons.aggregate.return_value = MockCursor([{"coupon_id": "CART20", "type": "cart-wise", "calculated_discount": 30.0}])
         
-        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{mock_cart_coupon['coupon_id']}")
+        response = client.get(f"/customers/{mock_customer_id}/applicable-coupons", params={"limit": 1})
         
         assert response.status_code == 200
-        assert response.json()["message"] == "Coupon applied successfully"
-        assert response.json()["discount_amount"] == 30.0  # 20% of 150, capped at 50
-        assert response.json()["original_total"] == 150.0
-        assert response.json()["final_total"] == 120.0
-        mock_customers.update_one.assert_called_once()
+        assert response.json() == {"applicable_coupons": [{"coupon_id": "CART20", "type": "cart-wise", "calculated_discount": 30.0}]}
+        pipeline = mock_coupons.aggregate.call_args[0][0]
+        assert pipeline[-1] == {"$limit": 1}
     
-    def test_apply_product_coupon(self, mock_db_connections):
+    def test_get_applicable_coupons_for_many_customers(self, client, mock_db_connections):
         mock_customers, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = mock_product_coupon
+        other_customer_id = "60d21b4667d0d8992e610c86"
+        mock_customers.seed({"_id": ObjectId(other_customer_id), "tier": "Basic", "cart": []})
         
-        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{mock_product_coupon['coupon_id']}")
+        response = send_json(client, "POST", "/customers/applicable-coupons", orjson.dumps(
+            {"customer_ids": [mock_customer_id, other_customer_id]}
+        ))
         
         assert response.status_code == 200
-        assert response.json()["message"] == "Coupon applied successfully"
-        assert response.json()["discount_amount"] == 15.0  # 15% of 100 (product p123)
-        assert response.json()["original_total"] == 150.0
-        assert response.json()["final_total"] == 135.0
+        assert response.json() == {
+            mock_customer_id: [
+                {"coupon_id": "CART20", "type": "cart-wise", "calculated_discount": 30.0},
+                {"coupon_id": "BUY2GET1", "type": "bxgy", "calculated_discount": 20.0},
+                {"coupon_id": "PROD15", "type": "product-wise", "calculated_discount": 15.0}
+            ],
+            other_customer_id: []
+        }
+        # One customers query and one coupons query, whatever the number of customers
+        assert len(mock_customers.called("find")) == 1
+        coupon_queries = mock_coupons.called("find")
+        assert len(coupon_queries) == 1
+        assert sorted(coupon_queries[0]["user_tiers"]["$in"]) == ["Basic", "Silver"]
     
-    def test_apply_bxgy_coupon(self, mock_db_connections):
-        mock_customers, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = mock_bxgy_coupon
+    def test_get_applicable_coupons_for_many_customers_not_found(self, client):
+        response = send_json(client, "POST", "/customers/applicable-coupons", orjson.dumps(
+            {"customer_ids": [mock_customer_id, unknown_customer_id]}
+        ))
         
-        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{mock_bxgy_coupon['coupon_id']}")
+        assert response.status_code == 404
+    
+    def test_get_applicable_coupons_for_too_many_customers(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
         
-        assert response.status_code == 200
-        assert response.json()["message"] == "Coupon applied successfully"
-        assert response.json()["discount_amount"] == 20.0  # 100% off on product p789
-        assert response.json()["original_total"] == 150.0
-        assert response.json()["final_total"] == 130.0
+        response = send_json(client, "POST", "/customers/applicable-coupons", orjson.dumps(
+            {"customer_ids": [mock_customer_id] * (MAX_BATCH_CUSTOMERS + 1)}
+        ))
+        
+        assert response.status_code == 422
+        assert not mock_customers.called("find")
     
-    def test_apply_nonexistent_coupon(self, mock_db_connections):
+    @pytest.mark.anyio
+    async def test_get_cart_and_applicable_coupons_concurrently(self, async_client, mock_db_connections):
         mock_customers, _, mock_coupons = mock_db_connections
-        mock_coupons.find_one.return_value = None
+        mock_customers.aggregate.return_value = MockCursor([{
+            "cart": [{**item, "subtotal": item["quantity"] * item["price"]} for item in mock_customer["cart"]],
+            "total": 150.0
+        }])
+        mock_coupons.aggregate.return_value = MockCursor([{"coupon_id": "CART20", "type": "cart-wise", "calculated_discount": 30.0}])
+        
+        cart_response, coupons_response = await asyncio.gather(
+            async_client.get(f"/customers/{mock_customer_id}/cart"),
+            async_client.get(f"/customers/{mock_customer_id}/applicable-coupons")
+        )
         
-        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/NONEXISTENT")
+        assert cart_response.status_code == 200
+        assert cart_response.json()["total"] == 150.0
+        assert coupons_response.status_code == 200
+        assert coupons_response.json()["applicable_coupons"][0]["coupon_id"] == "CART20"
+    
+    @pytest.mark.anyio
+    async def test_applicable_coupons_pipeline_error_raised_before_streaming(self, mock_db_connections):
+        _, _, mock_coupons = mock_db_connections
         
-        assert response.status_code == 404
-        assert "Coupon not found" in response.json()["detail"]
+        class FailingCursor(MockCursor):
+            async def __aiter__(self):
+                raise OperationFailure("PlanExecutor error during aggregation")
+                yield
+        
+        mock_coupons.aggregate.return_value = FailingCursor([])
+        
+        # Raised from the route itself, so it becomes a 500 rather than a truncated 200 body
+        with pytest.raises(OperationFailure):
+            await get_applicable_coupons(limit=None, oid=_CUST_OID)
     
-    def test_apply_expired_coupon(self, mock_db_connections):
-        mock_customers, _, mock_coupons = mock_db_connections
+    def test_applicable_coupons_cached_until_coupon_change(self, client, mock_db_connections):
+        _, _, mock_coupons = mock_db_connections
+        mock_coupons.aggregate.return_value = MockCursor([{**mock_cart_coupon, "calculated_discount": 30.0}])
         
-        expired_coupon = mock_cart_coupon.copy()
-        expired_coupon["valid_until"] = datetime.now() - timedelta(days=1)
-        mock_coupons.find_one.return_value = expired_coupon
+        first = client.get(f"/customers/{mock_customer_id}/applicable-coupons")
+        second = client.get(f"/customers/{mock_customer_id}/applicable-coupons")
         
-        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{expired_coupon['coupon_id']}")
+        assert first.json() == second.json()
+        mock_coupons.aggregate.assert_called_once()
         
-        assert response.status_code == 400
-        assert "expired" in response.json()["detail"]
+        # Any coupon write invalidates the cached rankings
+        client.delete(f"/coupons/{mock_cart_coupon['coupon_id']}")
+        client.get(f"/customers/{mock_customer_id}/applicable-coupons")
+        
+        assert mock_coupons.aggregate.call_count == 2
     
-    def test_apply_invalid_tier_coupon(self, mock_db_connections):
-        mock_customers, _, mock_coupons = mock_db_connections
+    @pytest.mark.anyio
+    async def test_applicable_coupons_not_cached_across_coupon_change(self, mock_db_connections):
+        _, _, mock_coupons = mock_db_connections
+        mock_coupons.aggregate.return_value = MockCursor([{**mock_cart_coupon, "calculated_discount": 30.0}])
         
-        tier_restricted_coupon = mock_cart_coupon.copy()
-        tier_restricted_coupon["user_tiers"] = ["Gold", "Platinum"]  # Customer is Silver
-        mock_coupons.find_one.return_value = tier_restricted_coupon
+        response = await get_applicable_coupons(limit=None, oid=_CUST_OID)
+        # A coupon write lands while the ranking is still being streamed
+        await delete_coupon(mock_cart_coupon["coupon_id"])
+        body = b"".join([chunk async for chunk in response.body_iterator])
         
-        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{tier_restricted_coupon['coupon_id']}")
+        assert orjson.loads(body)["applicable_coupons"][0]["coupon_id"] == mock_cart_coupon["coupon_id"]
+        assert coupons.applicable_coupons_cache == {}
+    
+    # HTTP contract only; the discount math per coupon type is covered by
+    # awaiting the route directly in test_apply_coupon_direct.py
+    def test_apply_coupon(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        
+        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{mock_cart_coupon['coupon_id']}")
+        
+        assert response.status_code == 200
+        assert response.json() == {
+            "message": "Coupon applied successfully",
+            "discount_amount": 30.0,
+            "original_total": 150.0,
+            "final_total": 120.0
+        }
+        mock_customers.update_one.assert_called_once()
+    
+    def test_apply_exhausted_exclusive_coupon(self, client, mock_db_connections):
+        mock_customers, _, mock_coupons = mock_db_connections
+        mock_coupons.seed({**mock_cart_coupon, "coupon_id": "EXCLUSIVE10"})
+        mock_customers.update_one.return_value = MagicMock(matched_count=0)  # Last use taken concurrently
+        
+        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/EXCLUSIVE10")
         
         assert response.status_code == 400
-        assert "not valid for Silver tier" in response.json()["detail"]
\ No newline at end of file
+        assert "used all your exclusive coupons" in response.json()["detail"]
+        update_filter, update = mock_customers.update_one.call_args[0]
+        assert update_filter["exclusive_coupons.EXCLUSIVE10"] == {"$gt": 0}
+        assert update["$inc"] == {"exclusive_coupons.EXCLUSIVE10": -1}
+        assert "$push" in update
+    
+    def test_apply_coupon_customer_deleted_meanwhile(self, client, mock_db_connections):
+        mock_customers, _, _ = mock_db_connections
+        mock_customers.update_one.return_value = MagicMock(matched_count=0)
+        
+        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{mock_cart_coupon['coupon_id']}")
+        
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Customer not found"
+    
+    @pytest.mark.parametrize("coupon,code,msg", [
+        (None, 404, "Coupon not found"),
+        ({**mock_cart_coupon, "valid_until": _NOW - timedelta(days=1)}, 400, "expired"),
+        ({**mock_cart_coupon, "user_tiers": ["Gold", "Platinum"]}, 400, "not valid for Silver tier")  # Customer is Silver
+    ], ids=["missing", "expired", "wrong_tier"])
+    def test_apply_rejects(self, client, mock_db_connections, coupon, code, msg):
+        mock_customers, _, mock_coupons = mock_db_connections
+        if coupon:
+            mock_coupons.seed(coupon)
+        coupon_id = coupon["coupon_id"] if coupon else "NONEXISTENT"
+        
+        response = client.post(f"/customers/{mock_customer_id}/apply-coupon/{coupon_id}")
+        
+        assert response.status_code == code
+        assert msg in response.json()["detail"]
+        mock_customers.update_one.assert_not_called()